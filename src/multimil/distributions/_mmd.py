@@ -15,6 +15,12 @@ class MMD(torch.nn.Module):
     def __init__(self, kernel_type: str = "gaussian"):
         super().__init__()
         self.kernel_type = kernel_type
+        # default kernel scales, kept as a buffer so they move with the module instead of being rebuilt every call
+        self.register_buffer(
+            "default_gamma",
+            torch.tensor([1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1, 1, 5, 10, 15, 20, 25, 30, 35, 100, 1e3, 1e4, 1e5, 1e6]),
+            persistent=False,
+        )
 
     def gaussian_kernel(
         self,
@@ -44,11 +50,9 @@ class MMD(torch.nn.Module):
             raise ValueError(f"Input tensors x and y must have the same shape, but got {x.shape} and {y.shape}")
 
         if gamma is None:
-            gamma = [1e-6, 1e-5, 1e-4, 1e-3, 1e-2, 1e-1,
-                     1, 5, 10, 15, 20, 25, 30, 35, 100,
-                     1e3, 1e4, 1e5, 1e6]
+            gamma = self.default_gamma
 
-        # Convert gamma to a torch.Tensor (ensure it's on the correct device)
+        # Convert gamma to a torch.Tensor (ensure it's on the correct device), a no-op for the default buffer in float32
         gamma = torch.as_tensor(gamma, device=x.device, dtype=x.dtype)
         D = torch.cdist(x, y).pow(2).unsqueeze(-1)
 
@@ -82,7 +86,7 @@ class MMD(torch.nn.Module):
         """
         # In case there is only one sample in a batch belonging to one of the groups, then skip the batch
         if len(x) == 1 or len(y) == 1:
-            return torch.tensor(0.0)
+            return x.new_zeros(())
 
         # Resampling logic to ensure x and y have the same shape NEW (03.10.2024)
         if x.shape[0] > y.shape[0]:
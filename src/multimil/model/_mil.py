@@ -86,6 +86,9 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         Whether to anneal the classification loss. Default is False.
     ignore_covariates
         List of covariates to ignore. Needed for query-to-reference mapping. Default is None.
+    use_checkpoint
+        Whether to use gradient checkpointing for the cell aggregator during training. Not applied with
+        ``normalization="batch"``. Default is True.
     """
 
     def __init__(
@@ -115,6 +118,7 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         initialization=None,  # xavier (tanh) or kaiming (leaky_relu)
         anneal_class_loss=False,
         ignore_covariates=None,
+        use_checkpoint=True,
     ):
         super().__init__(adata)
 
@@ -223,6 +227,7 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             ord_idx=self.ord_idx,
             reg_idx=self.regression_idx,
             anneal_class_loss=anneal_class_loss,
+            use_checkpoint=use_checkpoint,
         )
 
         self.init_params_ = self._get_init_params(locals())
@@ -249,6 +254,7 @@ class MILClassifier(BaseModelClass, ArchesMixin):
         early_stopping_mode: str | None = "max",
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        use_amp: bool = False,
         **kwargs,
     ):
         """Trains the model using amortized variational inference.
@@ -301,6 +307,9 @@ class MILClassifier(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs.
         path_to_checkpoints
             Path to save checkpoints.
+        use_amp
+            Whether to train in bfloat16 mixed precision, i.e. ``precision="bf16-mixed"`` for the
+            :class:`~scvi.train.Trainer`. An explicit ``precision`` in ``kwargs`` takes precedence. Default is False.
         **kwargs
             Other keyword args for :class:`~scvi.train.Trainer`.
 
@@ -355,6 +364,9 @@ class MILClassifier(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if use_amp:
+            kwargs.setdefault("precision", "bf16-mixed")
+
         data_splitter = GroupDataSplitter(
             self.adata_manager,
             group_column=self.sample_key,
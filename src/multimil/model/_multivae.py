@@ -72,6 +72,12 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         Initialization method to use.
     ignore_covariates
         List of covariates to ignore. Needed for query-to-reference mapping.
+    use_checkpoint
+        Whether to use gradient checkpointing for the encoders and decoders during training.
+        Not applied with ``normalization="batch"``.
+    use_mmd_checkpoint
+        Whether to use gradient checkpointing for the MMD terms of the integration loss during training.
+        Default is False.
     """
 
     def __init__(
@@ -98,6 +104,8 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         activation: str | None = "leaky_relu",  # TODO add which options are impelemted
         initialization: str | None = None,  # TODO add which options are impelemted
         ignore_covariates: list[str] | None = None,
+        use_checkpoint: bool = True,
+        use_mmd_checkpoint: bool = False,
     ):
         super().__init__(adata)
 
@@ -188,6 +196,8 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             mmd=mmd,
             activation=activation,
             initialization=initialization,
+            use_checkpoint=use_checkpoint,
+            use_mmd_checkpoint=use_mmd_checkpoint,
         )
 
         self.init_params_ = self._get_init_params(locals())
@@ -271,6 +281,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         plan_kwargs: dict | None = None,
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        use_amp: bool = False,
         **kwargs,
     ):
         """Train the model using amortized variational inference.
@@ -319,6 +330,9 @@ class MultiVAE(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs. If `None`, no checkpoints are saved.
         path_to_checkpoints
             Path to save checkpoints. Required if `save_checkpoint_every_n_epochs` is not `None`.
+        use_amp
+            Whether to train in bfloat16 mixed precision, i.e. ``precision="bf16-mixed"`` for the
+            :class:`~scvi.train.Trainer`. An explicit ``precision`` in ``kwargs`` takes precedence. Default is False.
         kwargs
             Additional keyword arguments for :class:`~scvi.train.TrainRunner`.
 
@@ -364,6 +378,9 @@ class MultiVAE(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if use_amp:
+            kwargs.setdefault("precision", "bf16-mixed")
+
         if self.group_column is not None:
             data_splitter = GroupDataSplitter(
                 self.adata_manager,
@@ -499,6 +516,7 @@ class MultiVAE(BaseModelClass, ArchesMixin):
         )
 
         attr_dict, _, load_state_dict = _get_loaded_data(reference_model, device=device)
+        MultiVAETorch._rename_legacy_keys(load_state_dict)  # reference models saved with the old sub-module names
 
         registry = attr_dict.pop("registry_")
         if _MODEL_NAME_KEY in registry and registry[_MODEL_NAME_KEY] != cls.__name__:
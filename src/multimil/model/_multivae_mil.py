@@ -118,6 +118,12 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         Initialization method for the weights.
     anneal_class_loss
         Whether to anneal the classification loss.
+    use_checkpoint
+        Whether to use gradient checkpointing for the encoders, decoders and the cell aggregator during training.
+        Not applied with ``normalization="batch"``.
+    use_mmd_checkpoint
+        Whether to use gradient checkpointing for the MMD terms of the integration loss during training.
+        Default is False.
     """
 
     def __init__(
@@ -162,6 +168,8 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         activation="leaky_relu",  # or tanh
         initialization="kaiming",  # xavier (tanh) or kaiming (leaky_relu)
         anneal_class_loss=False,
+        use_checkpoint=True,
+        use_mmd_checkpoint=False,
     ):
         super().__init__(adata)
 
@@ -319,6 +327,8 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             ord_idx=self.mil.ord_idx,
             reg_idx=self.mil.regression_idx,
             anneal_class_loss=anneal_class_loss,
+            use_checkpoint=use_checkpoint,
+            use_mmd_checkpoint=use_mmd_checkpoint,
         )
 
         self.init_params_ = self._get_init_params(locals())
@@ -345,6 +355,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         early_stopping_mode: str | None = "max",
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        use_amp: bool = False,
         **kwargs,
     ):
         """Trains the model.
@@ -397,6 +408,9 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs.
         path_to_checkpoints
             Path to save checkpoints.
+        use_amp
+            Whether to train in bfloat16 mixed precision, i.e. ``precision="bf16-mixed"`` for the
+            :class:`~scvi.train.Trainer`. An explicit ``precision`` in ``kwargs`` takes precedence. Default is False.
         **kwargs
             Other keyword args for :class:`~scvi.train.Trainer`.
 
@@ -450,6 +464,9 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
                     f"`save_checkpoint_every_n_epochs` = {save_checkpoint_every_n_epochs} so `path_to_checkpoints` has to be not None but is {path_to_checkpoints}."
                 )
 
+        if use_amp:
+            kwargs.setdefault("precision", "bf16-mixed")
+
         data_splitter = GroupDataSplitter(
             self.adata_manager,
             group_column=self.mil.sample_key,
@@ -828,6 +845,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
         save_loss=None,
         save_checkpoint_every_n_epochs: int | None = None,
         path_to_checkpoints: str | None = None,
+        use_amp: bool = False,
         **kwargs,
     ):
         """Train the VAE part of the model.
@@ -880,6 +898,9 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             Save a checkpoint every n epochs.
         path_to_checkpoints
             Path to save checkpoints.
+        use_amp
+            Whether to train in bfloat16 mixed precision, i.e. ``precision="bf16-mixed"`` for the
+            :class:`~scvi.train.Trainer`. An explicit ``precision`` in ``kwargs`` takes precedence. Default is False.
         kwargs
             Other keyword args for :class:`~scvi.train.Trainer`.
         """
@@ -913,6 +934,7 @@ class MultiVAE_MIL(BaseModelClass, ArchesMixin):
             plan_kwargs=plan_kwargs,
             save_checkpoint_every_n_epochs=save_checkpoint_every_n_epochs,
             path_to_checkpoints=path_to_checkpoints,
+            use_amp=use_amp,
             **kwargs,
         )
 
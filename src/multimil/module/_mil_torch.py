@@ -5,7 +5,7 @@ from torch import nn
 from torch.nn import functional as F
 
 from multimil.nn import MLP, Aggregator
-from multimil.utils import prep_minibatch, select_covariates
+from multimil.utils import maybe_checkpoint, prep_minibatch, select_covariates
 
 class MILClassifierTorch(BaseModuleClass):
     """MultiMIL's MIL classification module.
@@ -58,6 +58,9 @@ class MILClassifierTorch(BaseModuleClass):
         Initialization type.
     anneal_class_loss
         Whether to anneal the classification loss.
+    use_checkpoint
+        Whether to use gradient checkpointing for the cell aggregator during training.
+        Not applied with ``normalization="batch"``.
     """
 
     def __init__(
@@ -85,6 +88,7 @@ class MILClassifierTorch(BaseModuleClass):
         activation="leaky_relu",
         initialization=None,
         anneal_class_loss=False,
+        use_checkpoint=True,
     ):
         super().__init__()
 
@@ -104,9 +108,11 @@ class MILClassifierTorch(BaseModuleClass):
         self.sample_batch_size = sample_batch_size
         self.anneal_class_loss = anneal_class_loss
         self.num_classification_classes = num_classification_classes
-        self.class_idx = class_idx
-        self.ord_idx = ord_idx
-        self.reg_idx = reg_idx
+        self.register_buffer("class_idx", torch.as_tensor(class_idx, dtype=torch.long), persistent=False)
+        self.register_buffer("ord_idx", torch.as_tensor(ord_idx, dtype=torch.long), persistent=False)
+        self.register_buffer("reg_idx", torch.as_tensor(reg_idx, dtype=torch.long), persistent=False)
+        # batch norm would update its running statistics a second time in the recompute
+        self.use_checkpoint = use_checkpoint and normalization != "batch"
 
         self.cell_level_aggregator = nn.Sequential(
             MLP(
@@ -212,16 +218,13 @@ class MILClassifierTorch(BaseModuleClass):
         inference_outputs = {"z": z}
 
         # MIL part
-        batch_size = x.shape[0]
-
-        idx = list(range(self.sample_batch_size, batch_size, self.sample_batch_size))
-        if (
-            batch_size % self.sample_batch_size != 0
-        ):  # can only happen during inference for last batches for each sample
-            idx = []
-        zs = torch.tensor_split(z, idx, dim=0)
-        zs = torch.stack(zs, dim=0)  # num of bags x batch_size x z_dim
-        zs_attn = self.cell_level_aggregator(zs)  # num of bags x cond_dim
+        # bags are contiguous and of equal size, so they can be viewed as a batch of bags without copying
+        # batch_size % sample_batch_size != 0 can only happen during inference for last batches for each sample
+        _, n_samples_in_batch = prep_minibatch(z, self.sample_batch_size)
+        zs = z.reshape(n_samples_in_batch, -1, z.shape[-1])  # num of bags x batch_size x z_dim
+        zs_attn = maybe_checkpoint(
+            self.cell_level_aggregator, zs, enabled=self.use_checkpoint and self.training
+        )  # num of bags x cond_dim
 
         predictions = []
         if len(self.class_idx) > 0:
@@ -259,26 +262,29 @@ class MILClassifierTorch(BaseModuleClass):
 
         # MIL classification loss
         minibatch_size, n_samples_in_batch = prep_minibatch(cat_covs, self.sample_batch_size)
-        regression = select_covariates(cont_covs, self.reg_idx.to(self.device), n_samples_in_batch)
-        ordinal_regression = select_covariates(cat_covs, self.ord_idx.to(self.device), n_samples_in_batch)
-        classification = select_covariates(cat_covs, self.class_idx.to(self.device), n_samples_in_batch)
+        regression = select_covariates(cont_covs, self.reg_idx, n_samples_in_batch)
+        ordinal_regression = select_covariates(cat_covs, self.ord_idx, n_samples_in_batch)
+        classification = select_covariates(cat_covs, self.class_idx, n_samples_in_batch)
 
         predictions = inference_outputs["predictions"]  # list, first from classifiers, then from regressors
 
+        # collect the per-task terms and reduce them once at the end
         accuracies = []
-        classification_loss = torch.tensor(0.0).to(self.device)
+        classification_losses = []
         for i in range(len(self.class_idx)):
-            classification_loss += F.cross_entropy(
-                predictions[i], classification[:, i].long()
+            classification_losses.append(
+                F.cross_entropy(predictions[i], classification[:, i].long())
             )  # assume same in the batch
             accuracies.append(
                 torch.sum(torch.eq(torch.argmax(predictions[i], dim=-1), classification[:, i]))
                 / classification[:, i].shape[0]
             )
 
-        regression_loss = torch.tensor(0.0).to(self.device)
+        regression_losses = []
         for i in range(len(self.ord_idx)):
-            regression_loss += F.mse_loss(predictions[len(self.class_idx) + i].squeeze(-1), ordinal_regression[:, i])
+            regression_losses.append(
+                F.mse_loss(predictions[len(self.class_idx) + i].squeeze(-1), ordinal_regression[:, i])
+            )
             accuracies.append(
                 torch.sum(
                     torch.eq(
@@ -294,11 +300,17 @@ class MILClassifierTorch(BaseModuleClass):
             )
 
         for i in range(len(self.reg_idx)):
-            regression_loss += F.mse_loss(
-                predictions[len(self.class_idx) + len(self.ord_idx) + i].squeeze(-1),
-                regression[:, i],
+            regression_losses.append(
+                F.mse_loss(
+                    predictions[len(self.class_idx) + len(self.ord_idx) + i].squeeze(-1),
+                    regression[:, i],
+                )
             )
 
+        zero = inference_outputs["z"].new_zeros(())
+        classification_loss = torch.stack(classification_losses).sum() if len(classification_losses) > 0 else zero
+        regression_loss = torch.stack(regression_losses).sum() if len(regression_losses) > 0 else zero
+
         class_loss_anneal_coef = kl_weight if self.anneal_class_loss else 1.0
 
         loss = torch.mean(
@@ -312,7 +324,7 @@ class MILClassifierTorch(BaseModuleClass):
         }
 
         if len(accuracies) > 0:
-            accuracy = torch.sum(torch.tensor(accuracies)) / len(accuracies)
+            accuracy = torch.stack(accuracies).mean()
             extra_metrics["accuracy"] = accuracy
 
         # don't need in this model but have to return
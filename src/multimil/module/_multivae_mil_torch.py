@@ -96,6 +96,11 @@ class MultiVAETorch_MIL(BaseModuleClass):
         Initialization method to use.
     anneal_class_loss
         Whether to anneal the classification loss.
+    use_checkpoint
+        Whether to use gradient checkpointing for the encoders, decoders and the cell aggregator during training.
+        Not applied with ``normalization="batch"``.
+    use_mmd_checkpoint
+        Whether to use gradient checkpointing for the MMD terms of the integration loss during training.
     """
 
     def __init__(
@@ -144,6 +149,8 @@ class MultiVAETorch_MIL(BaseModuleClass):
         activation="leaky_relu",
         initialization=None,
         anneal_class_loss=False,
+        use_checkpoint=True,
+        use_mmd_checkpoint=False,
     ):
         super().__init__()
 
@@ -174,6 +181,8 @@ class MultiVAETorch_MIL(BaseModuleClass):
             mmd=mmd,
             activation=activation,
             initialization=initialization,
+            use_checkpoint=use_checkpoint,
+            use_mmd_checkpoint=use_mmd_checkpoint,
         )
         self.mil_module = MILClassifierTorch(
             z_dim=z_dim,
@@ -199,6 +208,7 @@ class MultiVAETorch_MIL(BaseModuleClass):
             normalization=normalization,
             scoring=scoring,
             attn_dim=attn_dim,
+            use_checkpoint=use_checkpoint,
         )
 
     def _get_inference_input(self, tensors):
@@ -1,3 +1,4 @@
+import re
 import warnings
 from typing import Literal
 
@@ -6,11 +7,11 @@ from scvi import REGISTRY_KEYS
 from scvi.distributions import NegativeBinomial, ZeroInflatedNegativeBinomial
 from scvi.module.base import BaseModuleClass, LossOutput, auto_move_data
 from torch import nn
-from torch.distributions import Normal
-from torch.distributions import kl_divergence as kl
+from torch.nn import functional as F
 
 from multimil.distributions import MMD
 from multimil.nn import MLP, Decoder, GeneralizedSigmoid
+from multimil.utils import maybe_checkpoint
 
 class MultiVAETorch(BaseModuleClass):
     """MultiMIL's multimodal integration module.
@@ -75,6 +76,13 @@ class MultiVAETorch(BaseModuleClass):
         * ``'latent'`` - only on the latent representations
         * ``'marginal'`` - only on the marginal representations
         * ``both`` - the sum of the two above.
+    use_checkpoint
+        Whether to use gradient checkpointing for the encoders and decoders during training, i.e. recompute their
+        activations in the backward pass instead of storing them. Not applied with ``normalization="batch"``, as the
+        recompute would update the running statistics of the batch normalization layers a second time.
+    use_mmd_checkpoint
+        Whether to use gradient checkpointing for the MMD terms of the integration loss during training, i.e. recompute
+        the kernel matrices in the backward pass instead of storing them.
     """
 
     def __init__(
@@ -105,6 +113,8 @@ class MultiVAETorch(BaseModuleClass):
         mmd="latent",
         activation="leaky_relu",
         initialization=None,
+        use_checkpoint=True,
+        use_mmd_checkpoint=False,
     ):
         super().__init__()
 
@@ -117,6 +127,7 @@ class MultiVAETorch(BaseModuleClass):
         self.n_cont_cov = len(cont_covariate_dims)
         self.cont_cov_type = cont_cov_type
         self.mmd = mmd
+        self.mmd_loss = MMD(kernel_type=kernel_type)  # no learned parameters, one instance serves all pairs
         self.normalization = normalization
         self.z_dim = z_dim
         self.dropout = dropout
@@ -128,8 +139,12 @@ class MultiVAETorch(BaseModuleClass):
         self.n_hidden_cont_embed = n_hidden_cont_embed
         self.n_hidden_encoders = n_hidden_encoders
         self.n_hidden_decoders = n_hidden_decoders
-        self.cat_covs_idx = cat_covs_idx
-        self.cont_covs_idx = cont_covs_idx
+        # buffers follow the module to its device, not saved in the state dict
+        self.register_buffer("cat_covs_idx", torch.as_tensor(cat_covs_idx, dtype=torch.long), persistent=False)
+        self.register_buffer("cont_covs_idx", torch.as_tensor(cont_covs_idx, dtype=torch.long), persistent=False)
+        # the recompute in backward would run batch norm in train mode again and update its running statistics twice
+        self.use_checkpoint = use_checkpoint and normalization != "batch"
+        self.use_mmd_checkpoint = use_mmd_checkpoint
 
         if activation == "leaky_relu":
             self.activation = nn.LeakyReLU
@@ -186,44 +201,54 @@ class MultiVAETorch(BaseModuleClass):
 
         # modality encoders
         cond_dim_enc = cond_dim * (len(cat_covariate_dims) + len(cont_covariate_dims)) if self.condition_encoders else 0
-        self.encoders = [
-            MLP(
-                n_input=x_dim + cond_dim_enc,
-                n_output=z_dim,
-                n_layers=n_layers,
-                n_hidden=n_hidden,
-                dropout_rate=dropout,
-                normalization=normalization,
-                activation=self.activation,
-            )
-            for x_dim, n_layers, n_hidden in zip(
-                self.input_dims, self.n_layers_encoders, self.n_hidden_encoders, strict=False
-            )
-        ]
+        self.encoders = nn.ModuleList(
+            [
+                MLP(
+                    n_input=x_dim + cond_dim_enc,
+                    n_output=z_dim,
+                    n_layers=n_layers,
+                    n_hidden=n_hidden,
+                    dropout_rate=dropout,
+                    normalization=normalization,
+                    activation=self.activation,
+                )
+                for x_dim, n_layers, n_hidden in zip(
+                    self.input_dims, self.n_layers_encoders, self.n_hidden_encoders, strict=False
+                )
+            ]
+        )
 
         # modality decoders
         cond_dim_dec = cond_dim * (len(cat_covariate_dims) + len(cont_covariate_dims)) if self.condition_decoders else 0
         dec_input = z_dim
-        self.decoders = [
-            Decoder(
-                n_input=dec_input + cond_dim_dec,
-                n_output=x_dim,
-                n_layers=n_layers,
-                n_hidden=n_hidden,
-                dropout_rate=dropout,
-                normalization=normalization,
-                activation=self.activation,
-                loss=loss,
-            )
-            for x_dim, loss, n_layers, n_hidden in zip(
-                self.input_dims, self.losses, self.n_layers_decoders, self.n_hidden_decoders, strict=False
-            )
-        ]
+        self.decoders = nn.ModuleList(
+            [
+                Decoder(
+                    n_input=dec_input + cond_dim_dec,
+                    n_output=x_dim,
+                    n_layers=n_layers,
+                    n_hidden=n_hidden,
+                    dropout_rate=dropout,
+                    normalization=normalization,
+                    activation=self.activation,
+                    loss=loss,
+                )
+                for x_dim, loss, n_layers, n_hidden in zip(
+                    self.input_dims, self.losses, self.n_layers_decoders, self.n_hidden_decoders, strict=False
+                )
+            ]
+        )
 
-        self.mus = [nn.Linear(z_dim, z_dim) for _ in self.input_dims]
-        self.logvars = [nn.Linear(z_dim, z_dim) for _ in self.input_dims]
+        self.mus = nn.ModuleList([nn.Linear(z_dim, z_dim) for _ in self.input_dims])
+        self.logvars = nn.ModuleList([nn.Linear(z_dim, z_dim) for _ in self.input_dims])
 
-        self.cat_covariate_embeddings = [nn.Embedding(dim, cond_dim) for dim in cat_covariate_dims]
+        self.cat_covariate_embeddings = nn.ModuleList([nn.Embedding(dim, cond_dim) for dim in cat_covariate_dims])
+        # offset of each covariate's categories in the concatenation of all embedding tables
+        self.register_buffer(
+            "cat_covariate_offsets",
+            torch.cumsum(torch.tensor([0] + list(cat_covariate_dims[:-1]), dtype=torch.long), dim=0),
+            persistent=False,
+        )
         if self.n_cont_cov > 0:
             self.cont_covariate_embeddings = nn.Embedding(self.n_cont_cov, cond_dim)
             if self.cont_cov_type == "mlp":
@@ -252,18 +277,6 @@ class MultiVAETorch(BaseModuleClass):
                     nonlin=self.cont_cov_type,
                 )
 
-        # register sub-modules
-        for i, (enc, dec, mu, logvar) in enumerate(
-            zip(self.encoders, self.decoders, self.mus, self.logvars, strict=False)
-        ):
-            self.add_module(f"encoder_{i}", enc)
-            self.add_module(f"decoder_{i}", dec)
-            self.add_module(f"mu_{i}", mu)
-            self.add_module(f"logvar_{i}", logvar)
-
-        for i, emb in enumerate(self.cat_covariate_embeddings):
-            self.add_module(f"cat_covariate_embedding_{i}", emb)
-
         if initialization is not None:
             if initialization == "xavier":
                 if activation != "leaky_relu":
@@ -285,6 +298,28 @@ class MultiVAETorch(BaseModuleClass):
                         # following https://towardsdatascience.com/understand-kaiming-initialization-and-implementation-detail-in-pytorch-f7aa967e9138 (accessed 16.08.22)
                         nn.init.kaiming_normal_(layer.weight, mode="fan_in")
 
+    @staticmethod
+    def _rename_legacy_keys(state_dict, prefix=""):
+        """Rename the keys of a state dict saved before the sub-modules were stored in ``nn.ModuleList``, in place.
+
+        Parameters
+        ----------
+        state_dict
+            State dict to update.
+        prefix
+            Prefix of the module's keys in ``state_dict``.
+        """
+        # sub-modules used to be registered one by one as e.g. "encoder_0", map such keys to the nn.ModuleList names
+        legacy_key = re.compile(rf"^{re.escape(prefix)}(encoder|decoder|mu|logvar|cat_covariate_embedding)_(\d+)\.")
+        for key in list(state_dict.keys()):
+            if (match := legacy_key.match(key)) is not None:
+                name, i = match.groups()
+                state_dict[f"{prefix}{name}s.{i}.{key[match.end():]}"] = state_dict.pop(key)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        self._rename_legacy_keys(state_dict, prefix)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _reparameterize(self, mu, logvar):
         std = torch.exp(0.5 * logvar)
         eps = torch.randn_like(std)
@@ -297,10 +332,10 @@ class MultiVAETorch(BaseModuleClass):
         return z, mu, logvar
 
     def _x_to_h(self, x, i):
-        return self.encoders[i](x)
+        return maybe_checkpoint(self.encoders[i], x, enabled=self.use_checkpoint and self.training)
 
     def _h_to_x(self, h, i):
-        x = self.decoders[i](h)
+        x = maybe_checkpoint(self.decoders[i], h, enabled=self.use_checkpoint and self.training)
         return x
 
     def _product_of_experts(self, mus, logvars, masks):
@@ -422,39 +457,32 @@ class MultiVAETorch(BaseModuleClass):
         -------
         Reconstructed values for each modality.
         """
-        z = z.unsqueeze(1).repeat(1, self.n_modality, 1)
-        zs = torch.split(z, 1, dim=1)
-
         if self.condition_decoders is True:
             cat_embedds = self._select_cat_covariates(cat_covs)
             cont_embedds = self._select_cont_covariates(cont_covs)
 
-            zs = [
-                torch.cat([z.squeeze(1), cat_embedds, cont_embedds], dim=-1) for z in zs
-            ]  # concat embedding to each modality x along the feature axis
+            # concat embedding to z along the feature axis, the decoder input is the same for each modality
+            z = torch.cat([z, cat_embedds, cont_embedds], dim=-1)
+        else:
+            z = z.unsqueeze(1)  # the unconditioned decoders get and return (batch_size, 1, ...) as before
 
-        rs = [self._h_to_x(z, mod) for mod, z in enumerate(zs)]
+        rs = [self._h_to_x(z, mod) for mod in range(self.n_modality)]
         return {"rs": rs}
 
     def _select_cat_covariates(self, cat_covs):
         if len(self.cat_covs_idx) > 0:
-            cat_covs = torch.index_select(cat_covs, 1, self.cat_covs_idx.to(self.device))
-            cat_embedds = [
-                cat_covariate_embedding(covariate.long())
-                for cat_covariate_embedding, covariate in zip(self.cat_covariate_embeddings, cat_covs.T, strict=False)
-            ]
-        else:
-            cat_embedds = []
-
-        if len(cat_embedds) > 0:
-            cat_embedds = torch.cat(cat_embedds, dim=-1)  # TODO check if concatenation is needed
+            cat_covs = torch.index_select(cat_covs, 1, self.cat_covs_idx)
+            # look up all covariates at once in the concatenated embedding tables instead of one lookup per covariate
+            embedding_table = torch.cat([embedding.weight for embedding in self.cat_covariate_embeddings], dim=0)
+            cat_embedds = F.embedding(cat_covs.long() + self.cat_covariate_offsets, embedding_table)
+            cat_embedds = cat_embedds.flatten(1)  # batch_size x (n_cat_covs * cond_dim)
         else:
             cat_embedds = torch.Tensor().to(self.device)
         return cat_embedds
 
     def _select_cont_covariates(self, cont_covs):
         if len(self.cont_covs_idx) > 0:
-            cont_covs = torch.index_select(cont_covs, 1, self.cont_covs_idx.to(self.device))
+            cont_covs = torch.index_select(cont_covs, 1, self.cont_covs_idx)
             if cont_covs.shape[-1] != self.n_cont_cov:  # get rid of size_factors
                 cont_covs = cont_covs[:, 0 : self.n_cont_cov]
             cont_embedds = self._compute_cont_cov_embeddings(cont_covs)
@@ -467,7 +495,7 @@ class MultiVAETorch(BaseModuleClass):
         if self.integrate_on_idx is not None:
             integrate_on = tensors.get(REGISTRY_KEYS.CAT_COVS_KEY)[:, self.integrate_on_idx]
         else:
-            integrate_on = torch.zeros(x.shape[0], 1).to(self.device)
+            integrate_on = None  # all cells are in one group
 
         size_factor = tensors.get(REGISTRY_KEYS.SIZE_FACTOR_KEY, None)
 
@@ -485,39 +513,38 @@ class MultiVAETorch(BaseModuleClass):
         recon_loss, modality_recon_losses = self._calc_recon_loss(
             xs, rs, self.losses, integrate_on, size_factor, self.loss_coefs, masks
         )
-        kl_loss = kl_weight * kl(Normal(mu, torch.sqrt(torch.exp(logvar))), Normal(0, 1)).sum(dim=1)
+        # closed-form KL(N(mu, exp(logvar)) || N(0, 1))
+        # keep the KL in full precision under mixed precision training, logvar.exp() is too coarse in bfloat16
+        mu, logvar = mu.float(), logvar.float()
+        kl_loss = kl_weight * 0.5 * (mu.pow(2) + logvar.exp() - logvar - 1.0).sum(dim=1)
 
-        if self.loss_coefs["integ"] == 0:
-            integ_loss = torch.tensor(0.0).to(self.device)
-        else:
-            integ_loss = torch.tensor(0.0).to(self.device)
+        # collect the integration terms and reduce them once, on the device of the latent
+        integ_losses = []
+        if self.loss_coefs["integ"] != 0:
             if self.mmd == "latent" or self.mmd == "both":
-                integ_loss += self._calc_integ_loss(z, integrate_on).to(self.device)
+                integ_losses.append(self._calc_integ_loss(z, integrate_on))
             if self.mmd == "marginal" or self.mmd == "both":
-                for i in range(len(masks)):
-                    for j in range(i + 1, len(masks)):
-                        idx_where_to_calc_mmd = torch.eq(
-                            masks[i] == masks[j],
-                            torch.eq(masks[i], torch.ones_like(masks[i])),
-                        )
-                        if idx_where_to_calc_mmd.any():  # if need to calc mmd for a group between modalities
-                            marginal_i = z_marginal[:, i, :][idx_where_to_calc_mmd]
-                            marginal_j = z_marginal[:, j, :][idx_where_to_calc_mmd]
-                            marginals = torch.cat([marginal_i, marginal_j])
-                            modalities = torch.cat(
-                                [
-                                    torch.Tensor([i] * marginal_i.shape[0]),
-                                    torch.Tensor([j] * marginal_j.shape[0]),
-                                ]
-                            ).to(self.device)
-
-                            integ_loss += self._calc_integ_loss(marginals, modalities).to(self.device)
-
-                for i in range(len(masks)):
-                    marginal_i = z_marginal[:, i, :]
-                    marginal_i = marginal_i[masks[i]]
-                    group_marginal = integrate_on[masks[i]]
-                    integ_loss += self._calc_integ_loss(marginal_i, group_marginal).to(self.device)
+                # cells to compare, computed for all pairs of modalities at once; for a pair (i, j) these are
+                # the cells where eq(masks[i] == masks[j], masks[i] == 1), i.e. where modality j is present
+                stacked_masks = torch.stack(masks, dim=1)  # batch_size x n_modalities
+                paired = stacked_masks.unsqueeze(1).expand(-1, self.n_modality, -1)  # batch_size x n_mod x n_mod
+                pairs = torch.triu_indices(self.n_modality, self.n_modality, offset=1)
+                # a single host sync to find out between which modalities mmd has to be calculated
+                pairs_to_calc = paired[:, pairs[0], pairs[1]].any(dim=0).tolist()
+                for (i, j), calc_mmd in zip(pairs.T.tolist(), pairs_to_calc, strict=True):
+                    if calc_mmd:  # if need to calc mmd for a group between modalities
+                        marginals = z_marginal[paired[:, i, j]][:, [i, j], :]  # n_paired x 2 x latent_dim
+                        modalities = torch.tensor([i, j], device=self.device).repeat(marginals.shape[0])
+                        integ_losses.append(self._calc_integ_loss(marginals.flatten(0, 1), modalities))
+
+                if integrate_on is not None:
+                    for i in range(len(masks)):
+                        # convert the mask to indices once and reuse them for both the marginals and the groups
+                        present = masks[i].nonzero(as_tuple=True)[0]
+                        marginal_i = z_marginal[present, i, :]
+                        group_marginal = integrate_on[present]
+                        integ_losses.append(self._calc_integ_loss(marginal_i, group_marginal))
+        integ_loss = torch.stack(integ_losses).sum() if len(integ_losses) > 0 else z.new_zeros(())
 
         loss = torch.mean(
             self.loss_coefs["recon"] * recon_loss
@@ -578,13 +605,14 @@ class MultiVAETorch(BaseModuleClass):
             if len(r) != 2 and len(r.shape) == 3:
                 r = r.squeeze()
             if loss_type == "mse":
-                mse_loss = loss_coefs[str(i)] * torch.sum(nn.MSELoss(reduction="none")(r, x), dim=-1)
+                mse_loss = loss_coefs[str(i)] * torch.sum(F.mse_loss(r, x, reduction="none"), dim=-1)
                 loss.append(mse_loss)
             elif loss_type == "nb":
                 dec_mean = r
                 size_factor_view = size_factor.expand(dec_mean.size(0), dec_mean.size(1))
                 dec_mean = dec_mean * size_factor_view
-                dispersion = self.theta.T[group.squeeze().long()]
+                # without groups there is a single dispersion per feature, broadcast over the cells
+                dispersion = self.theta.T[group.squeeze().long()] if group is not None else self.theta.T[:1]
                 dispersion = torch.exp(dispersion)
                 nb_loss = torch.sum(NegativeBinomial(mu=dec_mean, theta=dispersion).log_prob(x), dim=-1)
                 nb_loss = loss_coefs[str(i)] * nb_loss
@@ -595,7 +623,8 @@ class MultiVAETorch(BaseModuleClass):
                 dec_dropout = dec_dropout.squeeze()
                 size_factor_view = size_factor.unsqueeze(1).expand(dec_mean.size(0), dec_mean.size(1))
                 dec_mean = dec_mean * size_factor_view
-                dispersion = self.theta.T[group.squeeze().long()]
+                # without groups there is a single dispersion per feature, broadcast over the cells
+                dispersion = self.theta.T[group.squeeze().long()] if group is not None else self.theta.T[:1]
                 dispersion = torch.exp(dispersion)
                 zinb_loss = torch.sum(
                     ZeroInflatedNegativeBinomial(mu=dec_mean, theta=dispersion, zi_logits=dec_dropout).log_prob(x),
@@ -604,7 +633,10 @@ class MultiVAETorch(BaseModuleClass):
                 zinb_loss = loss_coefs[str(i)] * zinb_loss
                 loss.append(-zinb_loss)
             elif loss_type == "bce":
-                bce_loss = loss_coefs[str(i)] * torch.sum(torch.nn.BCELoss(reduction="none")(r, x), dim=-1)
+                # binary_cross_entropy is not autocast-safe, so compute it in full precision
+                with torch.autocast(device_type=r.device.type, enabled=False):
+                    bce_loss = F.binary_cross_entropy(r.float(), x.float(), reduction="none")
+                bce_loss = loss_coefs[str(i)] * torch.sum(bce_loss, dim=-1)
                 loss.append(bce_loss)
 
         return (
@@ -613,14 +645,25 @@ class MultiVAETorch(BaseModuleClass):
         )
 
     def _calc_integ_loss(self, z, group):
-        loss = torch.tensor(0.0).to(self.device)
-        unique = torch.unique(group)
+        if group is None:  # a single group, nothing to integrate
+            return z.new_zeros(())
+        losses = []
+        unique, counts = torch.unique(group, return_counts=True)
         if len(unique) > 1:
-            zs = [z[group == i] for i in unique]
+            # sort by group once and split, instead of one boolean mask per group; stable to keep the order in groups
+            zs = torch.split(z[torch.argsort(group, stable=True)], counts.tolist())
             for i in range(len(zs)):
                 for j in range(i + 1, len(zs)):
-                    loss += MMD(kernel_type=self.kernel_type)(zs[i], zs[j])
-        return loss
+                    # the kernel matrices are the largest activations of the loss, recompute them in backward
+                    losses.append(
+                        maybe_checkpoint(
+                            self.mmd_loss,
+                            zs[i],
+                            zs[j],
+                            enabled=self.use_mmd_checkpoint and self.training,
+                        )
+                    )
+        return torch.stack(losses).sum() if len(losses) > 0 else z.new_zeros(())
 
     def _compute_cont_cov_embeddings(self, covs):
         """Compute embeddings for continuous covariates.
@@ -632,7 +675,12 @@ class MultiVAETorch(BaseModuleClass):
         https://github.com/facebookresearch/CPA/blob/382ff641c588820a453d801e5d0e5bb56642f282/compert/model.py#L342
 
         """
-        if self.cont_cov_type == "mlp":
+        if self.cont_cov_type == "mlp" and self.n_layers_cont_embed == 1:
+            # each curve is a nn.Linear(1, 1), so all covariates can be transformed in one elementwise op
+            weight = torch.cat([curve.weight for curve in self.cont_covariate_curves], dim=1)  # 1 x n_cont_cov
+            bias = torch.cat([curve.bias for curve in self.cont_covariate_curves])  # n_cont_cov
+            return torch.addcmul(bias, covs, weight).sigmoid() @ self.cont_covariate_embeddings.weight
+        elif self.cont_cov_type == "mlp":
             embeddings = []
             for cov in range(covs.size(1)):
                 this_cov = covs[:, cov].view(-1, 1)
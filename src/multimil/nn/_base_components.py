@@ -4,6 +4,7 @@ import torch
 from scvi.nn import FCLayers
 from torch import nn
 from torch.nn import functional as F
+from torch.nn.utils.fusion import fuse_linear_bn_eval
 
 class MLP(nn.Module):
     """A helper class to build blocks of fully-connected, normalization, dropout and activation layers.
@@ -24,6 +25,9 @@ class MLP(nn.Module):
         Type of normalization to use. Can be one of ["layer", "batch", "none"].
     activation
         Activation function to use.
+    use_compile
+        Whether to compile the network with :func:`torch.compile`. Only applies to MLPs constructed directly, the
+        modules and models do not pass it through.
 
     """
 
@@ -36,6 +40,7 @@ class MLP(nn.Module):
         dropout_rate: float = 0.1,
         normalization: str = "layer",
         activation=nn.LeakyReLU,
+        use_compile: bool = False,
     ):
         super().__init__()
         use_layer_norm = False
@@ -56,6 +61,9 @@ class MLP(nn.Module):
             use_batch_norm=use_batch_norm,
             activation_fn=activation,
         )
+        if use_compile:
+            # compile in place so that the parameter names in the state dict stay the same
+            self.mlp.compile()
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
         """Forward computation on ``x``.
@@ -71,6 +79,25 @@ class MLP(nn.Module):
         """
         return self.mlp(x)
 
+    @torch.no_grad()
+    def fuse_(self) -> "MLP":
+        """Fold batch normalization layers into the preceding linear layers for inference.
+
+        Only has an effect with ``normalization="batch"``. The module is modified in place and has to be in eval mode,
+        afterwards it should only be used for inference as the batch normalization layers are removed.
+
+        Returns
+        -------
+        The fused module.
+        """
+        if self.training:
+            raise RuntimeError("MLP.fuse_() can only be called in eval mode.")
+        for layers in self.mlp.fc_layers:
+            if isinstance(layers[0], nn.Linear) and isinstance(layers[1], nn.BatchNorm1d):
+                layers[0] = fuse_linear_bn_eval(layers[0], layers[1])
+                layers[1] = None
+        return self
+
 class Decoder(nn.Module):
     """A helper class to build custom decoders depending on which loss was passed.
 
@@ -248,6 +275,9 @@ class Aggregator(nn.Module):
         if scoring not in allowed_scoring_methods:
             raise ValueError(f"Invalid scoring method: {scoring}. Must be one of {allowed_scoring_methods}.")
 
+        if scale and sample_batch_size is None:
+            raise ValueError("patient_batch_size must be set when scale is True.")
+
         self.scoring = scoring
         self.patient_batch_size = sample_batch_size
         self.scale = scale
@@ -289,51 +319,61 @@ class Aggregator(nn.Module):
                     nn.Linear(n_hidden_mlp_attn, 1),
                 )
 
+        # bind the pooling function once instead of dispatching on the scoring string in every forward pass
+        self._forward = {
+            "attn": self._attn,
+            "gated_attn": self._gated_attn,
+            "mlp": self._attn,
+            "sum": self._sum,
+            "mean": self._mean,
+            "max": self._max,
+        }[self.scoring]
+
     def forward(self, x) -> torch.Tensor:
         """Forward computation on `x`.
 
         Parameters
         ----------
         x : torch.Tensor
-            Input tensor of shape `(batch_size, N, n_input)`.
+            Input tensor of shape `(batch_size, N, n_input)`, or `(N, n_input)` for a single bag.
 
         Returns
         -------
         torch.Tensor
-            Aggregated output tensor of shape `(batch_size, n_input)`.
+            Aggregated output tensor of shape `(batch_size, n_input)`, or `(n_input,)` for a single bag.
         """
-        # Apply different pooling strategies based on the scoring method
-        if self.scoring in ["attn", "gated_attn", "mlp", "sum", "mean", "max"]:
-            if self.scoring == "attn":
-                # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
-                A = self.attention(x)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-            elif self.scoring == "gated_attn":
-                # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
-                A_V = self.attention_V(x)  # (batch_size, N, attn_dim)
-                A_U = self.attention_U(x)  # (batch_size, N, attn_dim)
-                A = self.attention_weights(A_V * A_U)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-            elif self.scoring == "mlp":
-                A = self.attention(x)  # (batch_size, N, 1)
-                A = A.transpose(1, 2)  # (batch_size, 1, N)
-                A = F.softmax(A, dim=-1)
-
-            elif self.scoring == "sum":
-                return torch.sum(x, dim=1)  # (batch_size, n_input)
-            elif self.scoring == "mean":
-                return torch.mean(x, dim=1)  # (batch_size, n_input)
-            elif self.scoring == "max":
-                return torch.max(x, dim=1).values  # (batch_size, n_input)
-            else:
-                raise NotImplementedError(
-                    f'scoring = {self.scoring} is not implemented. Has to be one of ["attn", "gated_attn", "mlp", "sum", "mean", "max"].'
-                    )
-            if self.scale:
-                if self.patient_batch_size is None:
-                    raise ValueError("patient_batch_size must be set when scale is True.")
-                A = A * A.shape[-1] / self.patient_batch_size
-
-            pooled = torch.bmm(A, x).squeeze(dim=1)  # (batch_size, n_input)
+        # a single bag is pooled as a batch of one, so that all scoring functions only have a 3D path
+        added = x.dim() == 2
+        x = x.unsqueeze(0) if added else x
+        out = self._forward(x)
+        return out.squeeze(0) if added else out
+
+    def _attn(self, x: torch.Tensor) -> torch.Tensor:
+        # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
+        A = self.attention(x)  # (batch_size, N, 1)
+        return self._attention_pooling(x, A)
+
+    def _gated_attn(self, x: torch.Tensor) -> torch.Tensor:
+        # from https://github.com/AMLab-Amsterdam/AttentionDeepMIL/blob/master/model.py (accessed 16.09.2021)
+        A_V = self.attention_V(x)  # (batch_size, N, attn_dim)
+        A_U = self.attention_U(x)  # (batch_size, N, attn_dim)
+        A = self.attention_weights(A_V * A_U)  # (batch_size, N, 1)
+        return self._attention_pooling(x, A)
+
+    def _sum(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.sum(x, dim=1)  # (batch_size, n_input)
+
+    def _mean(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.mean(x, dim=1)  # (batch_size, n_input)
+
+    def _max(self, x: torch.Tensor) -> torch.Tensor:
+        return torch.max(x, dim=1).values  # (batch_size, n_input)
+
+    def _attention_pooling(self, x: torch.Tensor, A: torch.Tensor) -> torch.Tensor:
+        A = F.softmax(A.squeeze(-1), dim=-1)  # (batch_size, N)
+        if self.scale:
+            A = A * A.shape[-1] / self.patient_batch_size
+
+        # save attention weights for get_model_output, detached so that the graph is not kept alive between steps
+        self.A = A.detach().unsqueeze(1)  # (batch_size, 1, N)
+        return torch.einsum("bnd,bn->bd", x, A)  # (batch_size, n_input)
@@ -3,6 +3,7 @@ from ._utils import (
     create_df,
     get_bag_info,
     get_predictions,
+    maybe_checkpoint,
     plt_plot_losses,
     prep_minibatch,
     save_predictions_in_adata,
@@ -20,4 +21,5 @@ __all__ = [
     "get_bag_info",
     "save_predictions_in_adata",
     "plt_plot_losses",
+    "maybe_checkpoint",
 ]
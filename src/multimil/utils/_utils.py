@@ -4,6 +4,7 @@ import pandas as pd
 import scipy
 import torch
 from matplotlib import pyplot as plt
+from torch.utils.checkpoint import checkpoint
 
 def create_df(pred, columns=None, index=None) -> pd.DataFrame:
     """Create a pandas DataFrame from a list of predictions.
@@ -149,8 +150,9 @@ def select_covariates(covs, prediction_idx, n_samples_in_batch) -> torch.Tensor:
         Prediction covariates.
     """
     if len(prediction_idx) > 0:
-        covs = torch.index_select(covs, 1, torch.tensor(prediction_idx))
-        covs = covs.view(n_samples_in_batch, -1, len(prediction_idx))[:, 0, :]
+        # all cells in a bag share the label, so take the first cell of each bag before selecting the columns
+        covs = covs.view(n_samples_in_batch, -1, covs.shape[-1])[:, 0, :]
+        covs = torch.index_select(covs, 1, torch.as_tensor(prediction_idx, dtype=torch.long, device=covs.device))
     else:
         covs = torch.tensor([])
     return covs
@@ -174,6 +176,29 @@ def prep_minibatch(covs, sample_batch_size) -> tuple[int, int]:
     n_samples_in_batch = 1 if batch_size % sample_batch_size != 0 else batch_size // sample_batch_size
     return batch_size, n_samples_in_batch
 
+def maybe_checkpoint(function, *args, enabled=True):
+    """Apply gradient checkpointing to ``function`` if enabled.
+
+    Activations of ``function`` are not stored but recomputed during the backward pass. Checkpointing is
+    skipped when gradients are disabled, e.g. during inference, as there are no activations to save then.
+
+    Parameters
+    ----------
+    function : callable
+        Function or module to call.
+    *args
+        Positional arguments passed to ``function``.
+    enabled : bool, optional
+        Whether to checkpoint the call.
+
+    Returns
+    -------
+    Output of ``function(*args)``.
+    """
+    if enabled and torch.is_grad_enabled():
+        return checkpoint(function, *args, use_reentrant=False)
+    return function(*args)
+
 def get_predictions(
     prediction_idx, pred_values, true_values, size, bag_pred, bag_true, full_pred, offset=0
 ) -> tuple[dict, dict, dict]:
@@ -1,6 +1,15 @@
+import re
+
+import anndata as ad
+import numpy as np
+import pandas as pd
 import pytest
+import torch
+from scvi import REGISTRY_KEYS
+from scvi.model.base._archesmixin import _get_loaded_data
 
 import multimil
+from multimil.distributions import MMD
 
 
 def test_package_has_version():
@@ -10,3 +19,145 @@ def test_package_has_version():
 @pytest.mark.skip(reason="This decorator should be removed when test passes.")
 def test_example():
     assert 1 == 0  # This test is designed to fail.
+
+
+def _legacy_state_dict(state_dict):
+    # sub-modules were registered one by one as e.g. "encoder_0" before they were stored in nn.ModuleList
+    legacy_key = re.compile(r"^(encoder|decoder|mu|logvar|cat_covariate_embedding)s\.(\d+)\.")
+    return {legacy_key.sub(r"\1_\2.", key): value for key, value in state_dict.items()}
+
+
+def _adata(batches, n_obs=40, seed=0):
+    rng = np.random.default_rng(seed)
+    adata = ad.AnnData(rng.poisson(2, (n_obs, 15)).astype(np.float32))
+    adata.obs_names = [f"cell_{i}" for i in range(n_obs)]
+    adata.obs["batch"] = pd.Categorical(rng.choice(batches, n_obs))
+    adata.uns["modality_lengths"] = {0: 10, 1: 5}
+    return adata
+
+
+def _multivae(adata, **kwargs):
+    multimil.model.MultiVAE.setup_anndata(adata, categorical_covariate_keys=["batch"], rna_indices_end=10)
+    return multimil.model.MultiVAE(adata, losses=["mse", "mse"], **kwargs)
+
+
+def test_load_legacy_state_dict():
+    model = _multivae(_adata(["a", "b"]))
+    state_dict = model.module.state_dict()
+    legacy = _legacy_state_dict(state_dict)
+    assert "encoder_0.mlp.fc_layers.Layer 0.0.weight" in legacy
+
+    module = _multivae(_adata(["a", "b"], seed=1)).module
+    module.load_state_dict(legacy)
+    for key, value in module.state_dict().items():
+        torch.testing.assert_close(value, state_dict[key])
+
+
+def test_load_query_data_legacy_state_dict(monkeypatch):
+    reference = _multivae(_adata(["a", "b"]))
+
+    def _get_loaded_legacy_data(reference_model, device=None):
+        attr_dict, var_names, load_state_dict = _get_loaded_data(reference_model, device=device)
+        return attr_dict, var_names, _legacy_state_dict(load_state_dict)
+
+    monkeypatch.setattr(multimil.model._multivae, "_get_loaded_data", _get_loaded_legacy_data)
+    query = multimil.model.MultiVAE.load_query_data(_adata(["c"], seed=1), reference_model=reference)
+
+    reference_weight = reference.module.encoders[0].mlp.fc_layers[0][0].weight
+    torch.testing.assert_close(query.module.encoders[0].mlp.fc_layers[0][0].weight, reference_weight)
+    # the embedding of the reference categories is kept, the new category is appended
+    embedding = query.module.cat_covariate_embeddings[0].weight
+    torch.testing.assert_close(embedding[:2], reference.module.cat_covariate_embeddings[0].weight)
+    assert embedding.shape[0] == 3
+
+
+@pytest.mark.parametrize("normalization", ["layer", "batch"])
+def test_checkpointing_does_not_change_training_step(normalization):
+    adata = _adata(["a", "b"])
+    state_dicts = []
+    for use_checkpoint in [True, False]:
+        torch.manual_seed(0)
+        model = _multivae(adata, normalization=normalization, use_checkpoint=use_checkpoint)
+        tensors = next(iter(model._make_data_loader(adata, batch_size=adata.n_obs)))
+        optimizer = torch.optim.SGD(model.module.parameters(), lr=0.1)
+
+        model.module.train()
+        torch.manual_seed(1)
+        _, _, losses = model.module(tensors)
+        losses.loss.backward()
+        optimizer.step()
+        state_dicts.append(model.module.state_dict())
+
+    checkpointed, plain = state_dicts
+    assert checkpointed.keys() == plain.keys()
+    for key in plain:  # including the running statistics of batch normalization
+        torch.testing.assert_close(checkpointed[key], plain[key])
+
+
+@pytest.mark.parametrize(("condition_decoders", "shape"), [(True, (40, 10)), (False, (40, 1, 10))])
+def test_impute_shape(condition_decoders, shape):
+    adata = _adata(["a", "b"])
+    model = _multivae(adata, condition_decoders=condition_decoders)
+    model.is_trained_ = True
+    model.impute()
+    assert adata.obsm["imputed_modality_0"].shape == shape
+    assert adata.obsm["imputed_modality_1"].shape == shape[:-1] + (5,)
+
+
+def test_marginal_mmd_pairing():
+    torch.manual_seed(0)
+    module = multimil.module.MultiVAETorch(
+        modality_lengths=[6, 5, 4],
+        losses=["mse"] * 3,
+        mmd="marginal",
+        loss_coefs={"integ": 1.0},
+        cat_covariate_dims=[],
+        cont_covariate_dims=[],
+        cat_covs_idx=torch.tensor([]),
+        cont_covs_idx=torch.tensor([]),
+    ).eval()
+    x = torch.rand(24, 15) + 0.1
+    x[:6, :6] = 0  # cells without the first modality
+    x[6:10, 6:11] = 0  # cells without the second modality
+    tensors = {REGISTRY_KEYS.X_KEY: x}
+    inference_outputs, generative_outputs, losses = module(tensors)
+
+    # the cells compared for modalities (i, j) are the ones where eq(m_i == m_j, m_i == 1), i.e. where m_j is present
+    z_marginal = inference_outputs["z_marginal"]
+    masks = [x[:, :6].sum(1) > 0, x[:, 6:11].sum(1) > 0, x[:, 11:].sum(1) > 0]
+    expected = sum(
+        MMD()(z_marginal[masks[j], i], z_marginal[masks[j], j]) for i in range(3) for j in range(i + 1, 3)
+    )
+    torch.testing.assert_close(losses.extra_metrics["integ_loss"], expected)
+
+
+@pytest.mark.parametrize("shape", [(8, 6), (3, 8, 6)])
+def test_mlp_fuse(shape):
+    torch.manual_seed(0)
+    mlp = multimil.nn.MLP(6, 4, n_layers=2, n_hidden=16, normalization="batch")
+    mlp.train()
+    for _ in range(3):  # populate the running statistics of batch normalization
+        mlp(torch.randn(32, 6))
+    mlp.eval()
+
+    x = torch.randn(*shape)
+    expected = mlp(x)
+    mlp.fuse_()
+    assert not any(isinstance(module, torch.nn.BatchNorm1d) for module in mlp.modules())
+    torch.testing.assert_close(mlp(x), expected)
+
+
+def test_mlp_fuse_in_training_mode():
+    mlp = multimil.nn.MLP(6, 4, normalization="batch")
+    with pytest.raises(RuntimeError):
+        mlp.fuse_()
+
+
+@pytest.mark.parametrize("scoring", ["attn", "gated_attn", "mlp", "sum", "mean", "max"])
+def test_aggregator_single_bag(scoring):
+    torch.manual_seed(0)
+    aggregator = multimil.nn.Aggregator(8, scoring=scoring).eval()
+    x = torch.randn(5, 8)
+    out = aggregator(x)
+    assert out.shape == (8,)
+    torch.testing.assert_close(out, aggregator(x.unsqueeze(0))[0])